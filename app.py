@@ -1,19 +1,79 @@
 # app.py - الملف الرئيسي للخادم المحسن
 
-from flask import Flask, request, jsonify, session, send_from_directory # أضفنا send_from_directory
+from flask import Flask, request, jsonify, session, send_file, redirect, make_response, Response
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import event, func, case, text, or_, and_, inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload, Session as OrmSession
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+from functools import wraps
 import secrets
 import os
 import json
+import threading
+import queue
+import bisect
+import heapq
+import time
+import gzip
+import hashlib
+import re
+import urllib.parse
+import urllib.request
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:  # ضغط brotli اختياري
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # بدون Pillow يتم التحويل للصور الأصلية
+    Image = None
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # مطلوبتان فقط لحساب التوصيات
+    np = sparse = None
 
 # إنشاء التطبيق
 app = Flask(__name__)
 app.config['SECRET_KEY'] = secrets.token_hex(16)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///tailoring_shop.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['FRAGMENT_CACHE_TTL'] = 60  # مدة صلاحية الأجزاء المخزنة مؤقتاً بالثواني
+app.config['BOOTSTRAP_PRODUCTS_LIMIT'] = 12  # عدد المنتجات في الصفحة الأولى عند التحميل
+app.config['IMAGE_CACHE_DIR'] = os.path.join(app.instance_path, 'image_cache')
+app.config['IMAGE_WIDTHS'] = (160, 320, 640)  # المقاسات المسموح بها للصور المصغرة
+app.config['IMAGE_FETCH_TIMEOUT'] = 5
+app.config['IMAGE_FAILURE_TTL'] = 5 * 60  # مدة تجنب إعادة جلب صورة أصلية فشل تحميلها
+app.config['RECOMMENDATIONS_TOP_N'] = 8  # عدد المنتجات المرتبطة المحفوظة لكل منتج
+app.config['RECOMMENDATIONS_REFRESH_INTERVAL'] = 6 * 60 * 60  # إعادة الحساب كل 6 ساعات
+# أوزان حساب المنتجات ذات الصلة: الشراء المشترك، نفس الفئة، نفس الخامة
+app.config['RECOMMENDATIONS_WEIGHTS'] = {'bought_together': 1.0, 'category': 0.3, 'material': 0.2}
+app.config['ORDERS_PER_PAGE'] = 10
+app.config['ORDERS_MAX_PER_PAGE'] = 50
+app.config['ORDER_STREAM_KEEPALIVE'] = 25  # ثواني بين رسائل الإبقاء على اتصال SSE
+app.config['ORDER_STREAM_POLL_INTERVAL'] = 5  # ثواني بين فحص تغييرات الطلبات من العمليات الأخرى
+app.config['IDEMPOTENCY_TTL'] = 24 * 60 * 60  # مدة الاحتفاظ بالردود المحفوظة بالثواني
+app.config['IDEMPOTENCY_PURGE_INTERVAL'] = 60 * 60
+app.config['IDEMPOTENCY_LOCK_TIMEOUT'] = 30  # بعدها يمكن لإعادة المحاولة تولي حجز لم يكتمل
+app.config['IDEMPOTENCY_PURGE_BATCH'] = 500
+app.config['BACKGROUND_TASKS_ENABLED'] = True  # تنظيف السلال والردود المحفوظة وتحديث التوصيات
+app.config['CART_TTL'] = 30 * 24 * 60 * 60  # حذف عناصر السلة غير المستخدمة بعد 30 يوماً
+app.config['CART_SWEEP_INTERVAL'] = 60 * 60
+app.config['CART_SWEEP_BATCH'] = 500
+app.config['CART_SWEEP_PAUSE'] = 0.05  # استراحة بين الدفعات حتى لا تحجز قاعدة البيانات طويلاً
+app.config['SEARCH_SUGGEST_LIMIT'] = 8
+app.config['SEARCH_SUGGEST_MAX_LIMIT'] = 20
+app.config['SEARCH_INDEX_REBUILD_INTERVAL'] = 5 * 60  # أقصى مدة لتأخر الفهرس عن تغييرات العمليات الأخرى
+app.config['READ_CACHE_FRESH_TTL'] = 5  # ثواني تقديم صفحات المنتجات من الذاكرة مباشرة
+app.config['READ_CACHE_STALE_TTL'] = 60  # ثواني تقديم النسخة القديمة أثناء تحديثها في الخلفية
+app.config['READ_CACHE_MAX_ENTRIES'] = 1000
 
 # إعداد قاعدة البيانات والـ CORS
 # تأكد من تفعيل supports_credentials للسماح بإرسال الكوكيز (الجلسات)
@@ -94,6 +154,20 @@ class Product(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    def image_sources(self):
+        """الصورة الرئيسية متبوعة بالصور الإضافية"""
+        main_image = self.image_url or f"https://via.placeholder.com/300x250?text={self.name}"
+        return [main_image] + (json.loads(self.additional_images) if self.additional_images else [])
+    
+    def thumbnail_url(self, index=0, width=320):
+        # النسخة تتغير فقط عند تغير الصور، وليس مع كل تحديث للمنتج مثل عداد المشاهدات
+        version = hashlib.sha1('\n'.join(self.image_sources()).encode('utf-8')).hexdigest()[:10]
+        return f"/media/products/{self.id}/{index}/{width}?v={version}"
+    
+    @property
+    def final_price(self):
+        return self.discount_price if self.discount_price else self.price
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -101,11 +175,12 @@ class Product(db.Model):
             'description': self.description,
             'price': self.price,
             'discount_price': self.discount_price,
-            'final_price': self.discount_price if self.discount_price else self.price,
+            'final_price': self.final_price,
             'has_discount': bool(self.discount_price),
             'category': self.category.name if self.category else None,
             'category_id': self.category_id,
             'image': self.image_url or f"https://via.placeholder.com/300x250?text={self.name}",
+            'thumbnail': self.thumbnail_url(),
             'additional_images': json.loads(self.additional_images) if self.additional_images else [],
             'in_stock': self.in_stock,
             'stock_quantity': self.stock_quantity,
@@ -128,10 +203,16 @@ class CartItem(db.Model):
     selected_color = db.Column(db.String(30))
     notes = db.Column(db.Text)  # ملاحظات خاصة للتفصيل
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     user = db.relationship('User', backref='cart_items')
     product = db.relationship('Product', backref='cart_items')
     
+    # يغطي البحث بالمستخدم وحده والبحث عن نفس العنصر في add_to_cart
+    __table_args__ = (
+        db.Index('ix_cart_item_lookup', 'user_id', 'product_id', 'selected_size', 'selected_color'),
+    )
+    
     def to_dict(self):
         product_dict = self.product.to_dict()
         return {
@@ -185,16 +266,40 @@ class Order(db.Model):
             'items': [item.to_dict() for item in self.order_items]
         }
     
-    def get_status_text(self):
-        status_map = {
-            'pending': 'في الانتظار',
-            'confirmed': 'مؤكد',
-            'in_progress': 'قيد التنفيذ',
-            'ready': 'جاهز للاستلام',
-            'delivered': 'مُسلم',
-            'cancelled': 'ملغي'
+    def to_summary_dict(self):
+        """نسخة مختصرة لسجل الطلبات بدون بيانات المنتجات الكاملة"""
+        return {
+            'id': self.id,
+            'order_number': self.order_number,
+            'total_amount': self.total_amount,
+            'status': self.status,
+            'status_text': self.get_status_text(),
+            'payment_status': self.payment_status,
+            'payment_method': self.payment_method,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+            'items': [item.to_summary_dict() for item in self.order_items]
         }
-        return status_map.get(self.status, self.status)
+    
+    # حالات نهائية لا يتوقع بعدها أي تغيير
+    FINAL_STATUSES = ('delivered', 'cancelled')
+    
+    STATUS_TEXT = {
+        'pending': 'في الانتظار',
+        'confirmed': 'مؤكد',
+        'in_progress': 'قيد التنفيذ',
+        'ready': 'جاهز للاستلام',
+        'delivered': 'مُسلم',
+        'cancelled': 'ملغي'
+    }
+    
+    # يستخدمه بث حالة الطلبات لفحص التغييرات الجديدة لكل مستخدم
+    __table_args__ = (
+        db.Index('ix_order_user_updated', 'user_id', 'updated_at'),
+    )
+    
+    def get_status_text(self):
+        return self.STATUS_TEXT.get(self.status, self.status)
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -202,6 +307,8 @@ class OrderItem(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
     quantity = db.Column(db.Integer)
     price = db.Column(db.Float)  # سعر المنتج وقت الطلب
+    product_name = db.Column(db.String(100))  # اسم المنتج وقت الطلب
+    product_image = db.Column(db.String(200))  # صورة المنتج المصغرة وقت الطلب
     selected_size = db.Column(db.String(20))
     selected_color = db.Column(db.String(30))
     notes = db.Column(db.Text)
@@ -220,6 +327,24 @@ class OrderItem(db.Model):
             'notes': self.notes,
             'total': self.price * self.quantity
         }
+    
+    def to_summary_dict(self):
+        # الطلبات القديمة لا تحتوي على نسخة من بيانات المنتج
+        name, image = self.product_name, self.product_image
+        if name is None and self.product:
+            name, image = self.product.name, self.product.thumbnail_url()
+        return {
+            'id': self.id,
+            'product_id': self.product_id,
+            'name': name,
+            'image': image,
+            'quantity': self.quantity,
+            'price': self.price,
+            'selected_size': self.selected_size,
+            'selected_color': self.selected_color,
+            'notes': self.notes,
+            'total': self.price * self.quantity
+        }
 
 class ContactMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -272,6 +397,359 @@ class Review(db.Model):
             'created_at': self.created_at.isoformat()
         }
 
+class ProductRelation(db.Model):
+    """المنتجات المرتبطة المحسوبة مسبقاً من سجل الطلبات"""
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    related_product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    relation_type = db.Column(db.String(20), nullable=False)  # related, bought_together
+    rank = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float)
+    
+    related_product = db.relationship('Product', foreign_keys=[related_product_id])
+    
+    __table_args__ = (
+        db.Index('ix_product_relation_lookup', 'product_id', 'relation_type', 'rank'),
+    )
+
+class IdempotencyRecord(db.Model):
+    """الرد المحفوظ لطلب كتابة يحمل Idempotency-Key لإعادته عند تكرار الطلب"""
+    id = db.Column(db.Integer, primary_key=True)
+    # نطاق المفتاح: user:<id> للمستخدم المسجل، أو anon:<بصمة الطلب> للطلبات بدون تسجيل دخول
+    scope = db.Column(db.String(80), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)  # فارغ أثناء تنفيذ الطلب الأصلي
+    response_body = db.Column(db.Text)
+    locked_until = db.Column(db.DateTime)  # مهلة حجز المفتاح أثناء التنفيذ
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    __table_args__ = (
+        db.Index('ix_idempotency_scope_key', 'scope', 'key', unique=True),
+    )
+
+# ========== التخزين المؤقت (Caching) ==========
+
+_fragment_cache = {}
+_fragment_cache_lock = threading.Lock()
+_fragment_generation = 0  # يزيد مع كل مسح حتى لا يحفظ جزء بُني قبل التغيير
+
+def get_cached_fragment(key, builder, ttl=None):
+    """إرجاع جزء مخزن مؤقتاً أو إعادة بنائه عند انتهاء صلاحيته"""
+    ttl = app.config['FRAGMENT_CACHE_TTL'] if ttl is None else ttl
+    now = time.monotonic()
+    with _fragment_cache_lock:
+        entry = _fragment_cache.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+        generation = _fragment_generation
+    value = builder()
+    with _fragment_cache_lock:
+        if generation == _fragment_generation:
+            _fragment_cache[key] = (now + ttl, value)
+    return value
+
+def invalidate_fragments():
+    """مسح كل الأجزاء المخزنة مؤقتاً"""
+    global _fragment_generation
+    with _fragment_cache_lock:
+        _fragment_cache.clear()
+        _fragment_generation += 1
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    """دمج القراءات المتزامنة لنفس المفتاح في عملية حساب واحدة، مع تقديم النسخة القديمة أثناء تحديثها"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # المفتاح -> (القيمة، صالحة حتى، يمكن تقديمها قديمة حتى)
+        self._inflight = {}
+        self._generation = 0  # يزيد مع كل مسح حتى لا تحفظ نتيجة حُسبت قبل التغيير
+        self.stats = {'requests': 0, 'computed': 0, 'coalesced': 0, 'fresh_hits': 0,
+                      'stale_hits': 0, 'background_refreshes': 0, 'errors': 0}
+    
+    def get(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            self.stats['requests'] += 1
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self.stats['fresh_hits'] += 1
+                return entry[0]
+            
+            if entry and entry[2] > now:
+                self.stats['stale_hits'] += 1
+                if key not in self._inflight:
+                    call = self._inflight[key] = _InFlightCall()
+                    self.stats['background_refreshes'] += 1
+                    threading.Thread(target=self._refresh_in_background,
+                                     args=(key, compute, call), daemon=True).start()
+                return entry[0]
+            
+            call = self._inflight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._inflight[key] = _InFlightCall()
+            else:
+                self.stats['coalesced'] += 1
+        
+        if is_leader:
+            self._run(key, compute, call)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.value
+    
+    def _refresh_in_background(self, key, compute, call):
+        with app.app_context():
+            self._run(key, compute, call)
+    
+    def _run(self, key, compute, call):
+        generation = self._generation
+        try:
+            call.value = compute()
+        except Exception as e:
+            call.error = e
+        
+        now = time.monotonic()
+        with self._lock:
+            # بعد المسح قد يكون هناك حساب أحدث لنفس المفتاح، فلا نحذفه
+            if self._inflight.get(key) is call:
+                del self._inflight[key]
+            if call.error is not None:
+                self.stats['errors'] += 1
+            else:
+                self.stats['computed'] += 1
+                if generation == self._generation:
+                    self._store(key, call.value, now)
+        call.done.set()
+    
+    def _store(self, key, value, now):
+        self._entries.pop(key, None)
+        if len(self._entries) >= app.config['READ_CACHE_MAX_ENTRIES']:
+            # حذف أقدم مفتاح (الترتيب حسب آخر تحديث)
+            self._entries.pop(next(iter(self._entries)))
+        fresh_until = now + app.config['READ_CACHE_FRESH_TTL']
+        self._entries[key] = (value, fresh_until, fresh_until + app.config['READ_CACHE_STALE_TTL'])
+    
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            # الطلبات الجديدة لا تنضم لحساب بدأ قبل التغيير، بل تبدأ حساباً جديداً
+            self._inflight.clear()
+            self._generation += 1
+
+product_reads = SingleFlight()
+
+# الحقول التي لا يستدعي تغييرها إعادة بناء الأجزاء (مثل عداد المشاهدات)
+_VOLATILE_FIELDS = {'views_count', 'updated_at'}
+
+def _on_catalog_change(mapper, connection, target):
+    state = sa_inspect(target)
+    changed = {attr.key for attr in state.attrs if attr.history.has_changes()}
+    if state.persistent and changed and changed <= _VOLATILE_FIELDS:
+        return
+    state.session.info['catalog_changed'] = True
+
+for _model in (Product, Category, Review):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event_name, _on_catalog_change)
+
+# المسح بعد الحفظ حتى لا يعاد بناء الذاكرة المؤقتة من بيانات لم تحفظ بعد
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_catalog_caches(db_session):
+    if db_session.info.pop('catalog_changed', False):
+        invalidate_fragments()
+        product_reads.invalidate()
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_catalog_change(db_session):
+    db_session.info.pop('catalog_changed', None)
+
+def build_categories_fragment():
+    categories = Category.query.filter_by(is_active=True).order_by(Category.sort_order).all()
+    return [cat.to_dict() for cat in categories]
+
+def build_products_fragment(featured_only=False, limit=None):
+    query = Product.query.options(joinedload(Product.category)).filter_by(is_active=True)
+    if featured_only:
+        query = query.filter_by(is_featured=True)
+    query = query.order_by(Product.created_at.desc())
+    if limit:
+        query = query.limit(limit)
+    return [product.to_dict() for product in query.all()]
+
+def get_cart_summary(user_id):
+    """ملخص السلة (عدد العناصر والإجمالي) باستعلام تجميعي واحد"""
+    final_price = case((Product.discount_price > 0, Product.discount_price), else_=Product.price)
+    count, total = db.session.query(
+        func.count(CartItem.id),
+        func.coalesce(func.sum(final_price * CartItem.quantity), 0)
+    ).join(Product, CartItem.product_id == Product.id).filter(CartItem.user_id == user_id).one()
+    return {'count': count, 'total': total}
+
+def build_product_list(category_id, featured_only, search_query):
+    query = Product.query.filter_by(is_active=True)
+    
+    if category_id:
+        query = query.filter_by(category_id=category_id)
+    
+    if featured_only:
+        query = query.filter_by(is_featured=True)
+    
+    if search_query:
+        query = query.filter(Product.name.contains(search_query) | Product.description.contains(search_query))
+    
+    products = query.options(joinedload(Product.category)).order_by(Product.created_at.desc()).all()
+    return [product.to_dict() for product in products]
+
+def build_product_detail(product_id):
+    product = Product.query.options(joinedload(Product.category)).filter_by(id=product_id, is_active=True).first()
+    if not product:
+        return None
+    
+    # جلب التقييمات
+    reviews = Review.query.options(joinedload(Review.user)) \
+        .filter_by(product_id=product_id, is_approved=True).order_by(Review.created_at.desc()).all()
+    
+    product_data = product.to_dict()
+    product_data['reviews'] = [review.to_dict() for review in reviews]
+    product_data['average_rating'] = sum(r.rating for r in reviews) / len(reviews) if reviews else 0
+    return product_data
+
+# ========== الملفات الثابتة (Static Assets) ==========
+
+STOREFRONT_PATH = os.path.join(app.root_path, 'index.html')
+_asset_bundle = {'mtime': None, 'files': {}}
+_asset_lock = threading.Lock()
+
+def minify_text(text):
+    """إزالة المسافات البادئة والأسطر الفارغة مع الحفاظ على فواصل الأسطر"""
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+def make_asset(content, mimetype, immutable):
+    data = content.encode('utf-8')
+    variants = {'identity': data, 'gzip': gzip.compress(data, 9)}
+    if brotli:
+        variants['br'] = brotli.compress(data, quality=11)
+    return {
+        'mimetype': mimetype,
+        'etag': hashlib.sha1(data).hexdigest(),
+        'immutable': immutable,
+        'variants': variants
+    }
+
+def build_storefront_assets():
+    """فصل CSS وJS من index.html وتصغيرها وضغطها مع بصمة في اسم الملف"""
+    with open(STOREFRONT_PATH, encoding='utf-8') as f:
+        html = f.read()
+    
+    files = {}
+    
+    def extract(ext, mimetype, tag_template):
+        def replace(match):
+            content = minify_text(match.group(1))
+            name = f"app.{hashlib.sha1(content.encode('utf-8')).hexdigest()[:10]}.{ext}"
+            files[name] = make_asset(content, mimetype, immutable=True)
+            return tag_template.format(name=name)
+        return replace
+    
+    html = re.sub(r'<style>(.*?)</style>',
+                  extract('css', 'text/css', '<link rel="stylesheet" href="/assets/{name}">'),
+                  html, count=1, flags=re.S)
+    html = re.sub(r'<script>(.*?)</script>',
+                  extract('js', 'application/javascript', '<script src="/assets/{name}"></script>'),
+                  html, count=1, flags=re.S)
+    html = re.sub(r'<!--.*?-->', '', html, flags=re.S)
+    
+    files['index.html'] = make_asset(minify_text(html), 'text/html', immutable=False)
+    return files
+
+def get_storefront_assets():
+    """إعادة البناء فقط عند تغير index.html"""
+    mtime = os.path.getmtime(STOREFRONT_PATH)
+    with _asset_lock:
+        if _asset_bundle['mtime'] != mtime:
+            _asset_bundle['files'] = build_storefront_assets()
+            _asset_bundle['mtime'] = mtime
+        return _asset_bundle['files']
+
+def serve_asset(asset):
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in asset['variants'] and request.accept_encodings.quality(candidate) > 0:
+            encoding = candidate
+            break
+    
+    response = Response(asset['variants'][encoding], mimetype=asset['mimetype'])
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    if asset['immutable']:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f"{asset['etag']}-{encoding}")
+    return response.make_conditional(request)
+
+def load_image_source(source):
+    """قراءة الصورة الأصلية من رابط خارجي أو من مجلد التطبيق"""
+    if source.startswith(('http://', 'https://')):
+        url = urllib.parse.quote(source, safe=':/?=&%+')
+        with urllib.request.urlopen(url, timeout=app.config['IMAGE_FETCH_TIMEOUT']) as remote:
+            return remote.read()
+    
+    path = os.path.normpath(os.path.join(app.root_path, source.lstrip('/')))
+    if not path.startswith(app.root_path + os.sep):
+        raise ValueError('مسار صورة غير صالح')
+    with open(path, 'rb') as f:
+        return f.read()
+
+_thumbnail_failures = {}  # الصورة الأصلية -> وقت السماح بإعادة المحاولة
+_thumbnail_locks = [threading.Lock() for _ in range(64)]  # أقفال موزعة حسب المفتاح
+
+def render_thumbnail(source, width, image_format):
+    """توليد صورة مصغرة وتخزينها على القرص، وإرجاع مسارها"""
+    cache_dir = app.config['IMAGE_CACHE_DIR']
+    key = hashlib.sha1(f"{source}|{width}".encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, f"{key}.{image_format}")
+    if os.path.exists(path):
+        return path
+    if _thumbnail_failures.get(source, 0) > time.monotonic():
+        raise ValueError('فشل تحميل الصورة الأصلية مؤخراً')
+    
+    # طلب واحد فقط يولد نفس الصورة المصغرة، والباقي ينتظر النتيجة
+    with _thumbnail_locks[int(key[:8], 16) % len(_thumbnail_locks)]:
+        if os.path.exists(path):
+            return path
+        if _thumbnail_failures.get(source, 0) > time.monotonic():
+            raise ValueError('فشل تحميل الصورة الأصلية مؤخراً')
+        
+        try:
+            image = Image.open(BytesIO(load_image_source(source)))
+        except Exception:
+            _thumbnail_failures[source] = time.monotonic() + app.config['IMAGE_FAILURE_TTL']
+            raise
+        _thumbnail_failures.pop(source, None)
+        
+        image.thumbnail((width, width * 4))
+        if image_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format=image_format.upper(), quality=80)
+        os.replace(tmp_path, path)
+        return path
+
 # ========== المساعدات (Helper Functions) ==========
 
 def generate_order_number():
@@ -423,18 +901,548 @@ def init_sample_data():
         db.session.commit()
         print("تم إضافة المستخدم الإداري")
 
+def delete_in_batches(model, condition, batch_size, pause=0):
+    """حذف الصفوف المطابقة على دفعات مع حفظ كل دفعة حتى لا تطول أقفال الكتابة"""
+    deleted = 0
+    while True:
+        ids = [row.id for row in db.session.query(model.id).filter(condition).limit(batch_size).all()]
+        if not ids:
+            return deleted
+        model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+
+def start_periodic_task(name, interval, task):
+    """تشغيل مهمة دورية في خيط خلفي داخل سياق التطبيق"""
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    task()
+            except Exception as e:
+                app.logger.exception("Periodic task %s failed: %s", name, e)
+            time.sleep(interval)
+    
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def upgrade_schema():
+    """إضافة الأعمدة والفهارس الجديدة للجداول الموجودة (create_all لا يعدل الجداول القائمة)"""
+    inspector = sa_inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+# ========== إشعارات الطلبات (Order Events) ==========
+
+class OrderEventBroker:
+    """توزيع تغييرات حالة الطلبات على اتصالات SSE المفتوحة لكل مستخدم (داخل العملية الواحدة)"""
+    
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+    
+    def subscribe(self, user_id):
+        subscription = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.setdefault(user_id, []).append(subscription)
+        return subscription
+    
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(user_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscribers.pop(user_id, None)
+    
+    def publish(self, user_id, payload):
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, []))
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait(payload)
+            except queue.Full:
+                pass  # عميل بطيء، سيحصل على الحالة الحالية عند إعادة الاتصال
+
+order_events = OrderEventBroker()
+
+def order_status_payload(order_id, order_number, status, changed_at):
+    return {
+        'order_id': order_id,
+        'order_number': order_number,
+        'status': status,
+        'status_text': Order.STATUS_TEXT.get(status, status),
+        'changed_at': changed_at.isoformat() if changed_at else None
+    }
+
+def get_order_statuses(user_id, since=None):
+    """حالات طلبات المستخدم (كلها أو المعدلة منذ وقت معين) باستعلام مفهرس خفيف"""
+    query = db.session.query(Order.id, Order.order_number, Order.status, Order.updated_at) \
+        .filter(Order.user_id == user_id)
+    if since is not None:
+        query = query.filter(Order.updated_at >= since)
+    return query.all()
+
+@event.listens_for(Order, 'after_update')
+def _collect_order_status_change(mapper, connection, target):
+    state = sa_inspect(target)
+    if not state.attrs.status.history.has_changes():
+        return
+    state.session.info.setdefault('order_status_events', []).append((target.user_id, order_status_payload(
+        target.id, target.order_number, target.status, datetime.utcnow())))
+
+# النشر يتم بعد الحفظ فقط حتى لا يرى العميل حالة تم التراجع عنها
+@event.listens_for(OrmSession, 'after_commit')
+def _publish_order_status_changes(db_session):
+    for user_id, payload in db_session.info.pop('order_status_events', []):
+        order_events.publish(user_id, payload)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_order_status_changes(db_session):
+    db_session.info.pop('order_status_events', None)
+
+# ========== الاقتراحات أثناء البحث (Search Suggestions) ==========
+
+_ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u0640]')
+_ARABIC_LETTER_MAP = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ة': 'ه', 'ؤ': 'و', 'ئ': 'ي'})
+
+def normalize_search_text(value):
+    """توحيد النص العربي للبحث: إزالة التشكيل والتطويل وتوحيد أشكال الحروف"""
+    value = _ARABIC_DIACRITICS.sub('', (value or '').lower()).translate(_ARABIC_LETTER_MAP)
+    return ' '.join(value.split())
+
+class SuggestionIndex:
+    """فهرس بادئات في الذاكرة (مصفوفة مرتبة + bisect) لأسماء المنتجات والفئات"""
+    
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []  # مفاتيح مرتبة من (النص الموحد، النوع، المعرف)
+        self._entries = {}  # (النوع، المعرف) -> {'name', 'keys'}
+        self._product_stats = {}  # معرف المنتج -> (المشاهدات، الفئة)
+        self._category_views = {}
+        self._rebuild_lock = threading.Lock()
+        self._pending_changes = None  # تغييرات وصلت أثناء البناء الأول، تطبق بعده
+        self.ready = False
+    
+    @staticmethod
+    def _suffix_keys(name, kind, item_id):
+        # كل كلمة في الاسم يمكن أن تكون بداية للبحث، مع وبدون "ال" التعريف
+        words = normalize_search_text(name).split()
+        keys = set()
+        for i, word in enumerate(words):
+            rest = words[i + 1:]
+            keys.add((' '.join([word] + rest), kind, item_id))
+            if word.startswith('ال') and len(word) > 3:
+                keys.add((' '.join([word[2:]] + rest), kind, item_id))
+        return keys
+    
+    def _remove(self, kind, item_id):
+        entry = self._entries.pop((kind, item_id), None)
+        if not entry:
+            return
+        for key in entry['keys']:
+            position = bisect.bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] == key:
+                del self._keys[position]
+    
+    def _add(self, kind, item_id, name):
+        keys = self._suffix_keys(name, kind, item_id)
+        self._entries[(kind, item_id)] = {'name': name, 'keys': keys}
+        for key in keys:
+            bisect.insort(self._keys, key)
+    
+    def _set_product_stats(self, product_id, views, category_id):
+        old_views, old_category = self._product_stats.pop(product_id, (0, None))
+        if old_category is not None:
+            self._category_views[old_category] = self._category_views.get(old_category, 0) - old_views
+        if views is None:
+            return
+        self._product_stats[product_id] = (views, category_id)
+        if category_id is not None:
+            self._category_views[category_id] = self._category_views.get(category_id, 0) + views
+    
+    def ensure_ready(self):
+        if not self.ready:
+            self.rebuild()
+    
+    def rebuild(self, force=False):
+        # طلب واحد فقط يبني الفهرس، والطلبات المتزامنة تنتظره
+        with self._rebuild_lock:
+            if self.ready and not force:
+                return
+            with self._lock:
+                self._pending_changes = []
+            products = db.session.query(Product.id, Product.name, Product.views_count, Product.category_id) \
+                .filter_by(is_active=True).all()
+            categories = db.session.query(Category.id, Category.name).filter_by(is_active=True).all()
+            self._load(products, categories)
+    
+    def _load(self, products, categories):
+        with self._lock:
+            self._keys, self._entries, self._product_stats, self._category_views = [], {}, {}, {}
+            for product in products:
+                self._entries[('product', product.id)] = {
+                    'name': product.name,
+                    'keys': self._suffix_keys(product.name, 'product', product.id)
+                }
+                self._set_product_stats(product.id, product.views_count or 0, product.category_id)
+            for category in categories:
+                self._entries[('category', category.id)] = {
+                    'name': category.name,
+                    'keys': self._suffix_keys(category.name, 'category', category.id)
+                }
+            self._keys = sorted(key for entry in self._entries.values() for key in entry['keys'])
+            # تطبيق ما تم حفظه أثناء قراءة البيانات (إعادة التطبيق آمنة إن كانت القراءة قد شملته)
+            for change in self._pending_changes or []:
+                self._apply_change(change)
+            self._pending_changes = None
+            self.ready = True
+    
+    def apply_changes(self, changes):
+        """تحديث الفهرس جزئياً بالمنتجات والفئات التي تغيرت فقط"""
+        with self._lock:
+            # أثناء البناء تحفظ التغييرات لتطبق على الفهرس الجديد بعد استبداله
+            if self._pending_changes is not None:
+                self._pending_changes.extend(changes)
+            # قبل البناء الأول لا حاجة للتطبيق، فالبناء سيقرأ البيانات المحفوظة
+            if not self.ready:
+                return
+            for change in changes:
+                self._apply_change(change)
+    
+    def _apply_change(self, change):
+        kind, item_id = change['kind'], change['id']
+        if kind == 'product':
+            self._set_product_stats(item_id, change['views'] if change['active'] else None,
+                                    change['category_id'])
+        if change.get('views_only'):
+            return
+        self._remove(kind, item_id)
+        if change['active']:
+            self._add(kind, item_id, change['name'])
+    
+    def record_view(self, product_id):
+        with self._lock:
+            if product_id in self._product_stats:
+                views, category_id = self._product_stats[product_id]
+                self._set_product_stats(product_id, views + 1, category_id)
+    
+    def _popularity(self, kind, item_id):
+        if kind == 'product':
+            return self._product_stats.get(item_id, (0, None))[0]
+        return self._category_views.get(item_id, 0)
+    
+    def suggest(self, query, limit):
+        prefix = normalize_search_text(query)
+        if not prefix:
+            return []
+        with self._lock:
+            matches = set()
+            position = bisect.bisect_left(self._keys, (prefix,))
+            while position < len(self._keys) and self._keys[position][0].startswith(prefix):
+                matches.add(self._keys[position][1:])
+                position += 1
+            best = heapq.nlargest(limit, matches, key=lambda match: (self._popularity(*match), -match[1]))
+            return [{'type': kind, 'id': item_id, 'name': self._entries[(kind, item_id)]['name']}
+                    for kind, item_id in best]
+
+suggestion_index = SuggestionIndex()
+
+def refresh_suggestion_index():
+    """إعادة بناء الفهرس دورياً لالتقاط تغييرات العمليات الأخرى والمشاهدات المسجلة فيها"""
+    suggestion_index.rebuild(force=True)
+
+def _collect_suggestion_change(target, deleted):
+    state = sa_inspect(target)
+    changed = {attr.key for attr in state.attrs if attr.history.has_changes()}
+    is_product = isinstance(target, Product)
+    change = {
+        'kind': 'product' if is_product else 'category',
+        'id': target.id,
+        'name': target.name,
+        'active': bool(target.is_active) and not deleted,
+        'views_only': not deleted and bool(changed) and changed <= _VOLATILE_FIELDS
+    }
+    if is_product:
+        change['views'] = target.views_count or 0
+        change['category_id'] = target.category_id
+    state.session.info.setdefault('suggestion_changes', []).append(change)
+
+def _on_suggestion_source_saved(mapper, connection, target):
+    _collect_suggestion_change(target, deleted=False)
+
+def _on_suggestion_source_deleted(mapper, connection, target):
+    _collect_suggestion_change(target, deleted=True)
+
+for _model in (Product, Category):
+    event.listen(_model, 'after_insert', _on_suggestion_source_saved)
+    event.listen(_model, 'after_update', _on_suggestion_source_saved)
+    event.listen(_model, 'after_delete', _on_suggestion_source_deleted)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _apply_suggestion_changes(db_session):
+    changes = db_session.info.pop('suggestion_changes', None)
+    if changes:
+        suggestion_index.apply_changes(changes)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_suggestion_changes(db_session):
+    db_session.info.pop('suggestion_changes', None)
+
+# ========== تنظيف السلال المهجورة (Cart Expiry) ==========
+
+def sweep_expired_cart_items():
+    """حذف عناصر السلة التي لم تُعدل منذ CART_TTL"""
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['CART_TTL'])
+    # العناصر القديمة المضافة قبل عمود updated_at تعتمد على created_at
+    expired = or_(CartItem.updated_at < cutoff,
+                  and_(CartItem.updated_at.is_(None), CartItem.created_at < cutoff))
+    deleted = delete_in_batches(CartItem, expired, app.config['CART_SWEEP_BATCH'],
+                                pause=app.config['CART_SWEEP_PAUSE'])
+    if deleted:
+        app.logger.info("Cart sweeper removed %d expired items", deleted)
+    return deleted
+
+@app.cli.command('sweep-carts')
+def sweep_carts_command():
+    """حذف عناصر السلة المنتهية"""
+    print(f"تم حذف {sweep_expired_cart_items()} عنصر منتهي من السلال")
+
+# ========== منع تكرار الطلبات (Idempotency) ==========
+
+def idempotent(view):
+    """إعادة الرد الأصلي عند تكرار طلب بنفس Idempotency-Key بدلاً من تنفيذه مرة أخرى"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key', '').strip()
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 100:
+            return jsonify({'error': 'مفتاح Idempotency-Key طويل جداً'}), 400
+        
+        user_id = session.get('user_id')
+        request_hash = hashlib.sha256(
+            f"{request.method} {request.path}\n".encode('utf-8') + request.get_data()
+        ).hexdigest()
+        # الطلبات بدون تسجيل دخول لا تملك هوية ثابتة، فبصمة الطلب نفسها تفصل بين العملاء
+        scope = f"user:{user_id}" if user_id else f"anon:{request_hash}"
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+        
+        record = IdempotencyRecord.query.filter_by(scope=scope, key=key).first()
+        if record and record.expires_at <= now:
+            db.session.delete(record)
+            db.session.commit()
+            record = None
+        
+        if record:
+            if record.request_hash != request_hash:
+                return jsonify({'error': 'تم استخدام هذا المفتاح مع طلب مختلف'}), 422
+            if record.status_code is not None:
+                response = Response(record.response_body, status=record.status_code, mimetype='application/json')
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+            
+            # حجز لم يكتمل (مثلاً توقفت العملية أثناء التنفيذ): يمكن توليه بعد انتهاء مهلته
+            taken = IdempotencyRecord.query.filter(
+                IdempotencyRecord.id == record.id,
+                IdempotencyRecord.status_code.is_(None),
+                or_(IdempotencyRecord.locked_until.is_(None), IdempotencyRecord.locked_until <= now)
+            ).update({IdempotencyRecord.locked_until: lease_until}, synchronize_session=False)
+            db.session.commit()
+            if not taken:
+                return jsonify({'error': 'الطلب الأصلي ما زال قيد التنفيذ'}), 409
+        else:
+            # حجز المفتاح قبل التنفيذ حتى لا ينفذ طلبان متزامنان بنفس المفتاح
+            record = IdempotencyRecord(
+                scope=scope,
+                key=key,
+                request_hash=request_hash,
+                locked_until=lease_until,
+                expires_at=now + timedelta(seconds=app.config['IDEMPOTENCY_TTL'])
+            )
+            db.session.add(record)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return jsonify({'error': 'الطلب الأصلي ما زال قيد التنفيذ'}), 409
+        
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            db.session.delete(record)
+            db.session.commit()
+            raise
+        
+        # أخطاء الخادم لا تحفظ حتى يمكن إعادة المحاولة بنفس المفتاح
+        if response.status_code >= 500:
+            db.session.delete(record)
+        else:
+            record.status_code = response.status_code
+            record.response_body = response.get_data(as_text=True)
+        db.session.commit()
+        return response
+    
+    return wrapper
+
+def purge_expired_idempotency_records():
+    """حذف الردود المنتهية على دفعات صغيرة"""
+    return delete_in_batches(IdempotencyRecord, IdempotencyRecord.expires_at <= datetime.utcnow(),
+                             app.config['IDEMPOTENCY_PURGE_BATCH'])
+
+@app.cli.command('purge-idempotency')
+def purge_idempotency_command():
+    """حذف ردود Idempotency-Key المنتهية"""
+    print(f"تم حذف {purge_expired_idempotency_records()} رد محفوظ منتهي")
+
+# ========== التوصيات (Recommendations) ==========
+
+def _one_hot(keys):
+    """مصفوفة متفرقة (منتج × قيمة) مع تجاهل القيم الفارغة"""
+    labels = {}
+    rows = [i for i, key in enumerate(keys) if key]
+    cols = [labels.setdefault(keys[i], len(labels)) for i in rows]
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(keys), max(len(labels), 1)))
+
+def _co_purchase_matrix(index_of, n):
+    """مصفوفة الشراء المشترك (منتج × منتج) مطبعة بجيب التمام"""
+    rows = db.session.query(OrderItem.order_id, OrderItem.product_id).distinct().all()
+    pairs = [(order_id, index_of[product_id]) for order_id, product_id in rows if product_id in index_of]
+    if not pairs:
+        return sparse.csr_matrix((n, n))
+    
+    order_ids, cols = zip(*pairs)
+    order_codes = np.unique(np.array(order_ids), return_inverse=True)[1]
+    baskets = sparse.csr_matrix((np.ones(len(cols)), (order_codes, cols)), shape=(order_codes.max() + 1, n))
+    
+    co_purchase = (baskets.T @ baskets).tocsr()
+    co_purchase.setdiag(0)
+    co_purchase.eliminate_zeros()
+    
+    norm = sparse.diags(1 / np.sqrt(np.maximum(np.asarray(baskets.sum(axis=0)).ravel(), 1)))
+    return (norm @ co_purchase @ norm).tocsr()
+
+def _top_neighbors(matrix, top_n):
+    """أعلى N جيران لكل صف في مصفوفة متفرقة"""
+    matrix = matrix.tocsr()
+    for i in range(matrix.shape[0]):
+        start, end = matrix.indptr[i], matrix.indptr[i + 1]
+        cols, scores = matrix.indices[start:end], matrix.data[start:end]
+        keep = (scores > 0) & (cols != i)
+        cols, scores = cols[keep], scores[keep]
+        if len(scores) > top_n:
+            best = np.argpartition(-scores, top_n)[:top_n]
+            cols, scores = cols[best], scores[best]
+        order = np.lexsort((cols, -scores))
+        yield i, cols[order], scores[order]
+
+def build_product_relations(top_n=None):
+    """حساب المنتجات المرتبطة وحفظ أعلى N لكل منتج في جدول ProductRelation"""
+    if np is None or sparse is None:
+        raise RuntimeError('مكتبتا numpy و scipy مطلوبتان لحساب التوصيات')
+    
+    top_n = top_n or app.config['RECOMMENDATIONS_TOP_N']
+    weights = app.config['RECOMMENDATIONS_WEIGHTS']
+    
+    products = db.session.query(Product.id, Product.category_id, Product.material) \
+        .filter_by(is_active=True).order_by(Product.id).all()
+    product_ids = [p.id for p in products]
+    index_of = {product_id: i for i, product_id in enumerate(product_ids)}
+    n = len(products)
+    
+    relations = []
+    if n:
+        co_purchase = _co_purchase_matrix(index_of, n)
+        categories = _one_hot([p.category_id for p in products])
+        materials = _one_hot([(p.material or '').strip().lower() for p in products])
+        related = (weights['bought_together'] * co_purchase
+                   + weights['category'] * (categories @ categories.T)
+                   + weights['material'] * (materials @ materials.T))
+        
+        for relation_type, matrix in (('bought_together', co_purchase), ('related', related)):
+            for i, cols, scores in _top_neighbors(matrix, top_n):
+                for rank, (col, score) in enumerate(zip(cols.tolist(), scores.tolist())):
+                    relations.append({
+                        'product_id': product_ids[i],
+                        'related_product_id': product_ids[col],
+                        'relation_type': relation_type,
+                        'rank': rank,
+                        'score': score
+                    })
+    
+    # استبدال الجدول بالكامل في معاملة واحدة
+    ProductRelation.query.delete()
+    db.session.bulk_insert_mappings(ProductRelation, relations)
+    db.session.commit()
+    return len(relations)
+
+@app.cli.command('build-recommendations')
+def build_recommendations_command():
+    """إعادة حساب المنتجات المرتبطة من سجل الطلبات"""
+    count = build_product_relations()
+    print(f"تم حفظ {count} علاقة بين المنتجات")
+
 # ========== المسارات (Routes) ==========
 
 # المسار لخدمة ملف index.html
 @app.route('/')
 def serve_index():
-    # سيتم البحث عن index.html داخل مجلد 'static'
-    return send_from_directory('static', 'index.html')
+    return serve_asset(get_storefront_assets()['index.html'])
+
+@app.route('/assets/<filename>')
+def serve_static_asset(filename):
+    asset = get_storefront_assets().get(filename)
+    if not asset or filename == 'index.html':
+        return jsonify({'error': 'الملف غير موجود'}), 404
+    return serve_asset(asset)
+
+@app.route('/media/products/<int:product_id>/<int:index>/<int:width>')
+def get_product_image(product_id, index, width):
+    if width not in app.config['IMAGE_WIDTHS']:
+        return jsonify({'error': 'مقاس الصورة غير مدعوم'}), 404
+    
+    product = Product.query.get(product_id)
+    if not product:
+        return jsonify({'error': 'المنتج غير موجود'}), 404
+    
+    sources = product.image_sources()
+    if index >= len(sources):
+        return jsonify({'error': 'الصورة غير موجودة'}), 404
+    source = sources[index]
+    
+    if Image is None:
+        return redirect(source)
+    
+    image_format = 'webp' if request.accept_mimetypes.quality('image/webp') > 0 else 'jpeg'
+    try:
+        path = render_thumbnail(source, width, image_format)
+    except Exception as e:
+        app.logger.warning("Thumbnail generation failed for %s: %s", source, e)
+        return redirect(source)
+    
+    response = send_file(path, mimetype=f"image/{image_format}", conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Vary'] = 'Accept'
+    return response
 
 @app.route('/api/categories', methods=['GET'])
 def get_categories():
-    categories = Category.query.filter_by(is_active=True).order_by(Category.sort_order).all()
-    return jsonify([cat.to_dict() for cat in categories])
+    return jsonify(get_cached_fragment('categories', build_categories_fragment))
 
 @app.route('/api/products', methods=['GET'])
 def get_products():
@@ -442,39 +1450,52 @@ def get_products():
     featured_only = request.args.get('featured') == 'true'
     search_query = request.args.get('search', '').strip()
     
-    query = Product.query.filter_by(is_active=True)
-    
-    if category_id:
-        query = query.filter_by(category_id=category_id)
-    
-    if featured_only:
-        query = query.filter_by(is_featured=True)
-    
-    if search_query:
-        query = query.filter(Product.name.contains(search_query) | Product.description.contains(search_query))
-    
-    products = query.order_by(Product.created_at.desc()).all()
-    return jsonify([product.to_dict() for product in products])
+    products = product_reads.get(('products', category_id, featured_only, search_query),
+                                 lambda: build_product_list(category_id, featured_only, search_query))
+    return jsonify(products)
+
+@app.route('/api/search/suggest', methods=['GET'])
+def search_suggest():
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', app.config['SEARCH_SUGGEST_LIMIT'], type=int),
+                app.config['SEARCH_SUGGEST_MAX_LIMIT'])
+    suggestion_index.ensure_ready()
+    
+    response = jsonify({'suggestions': suggestion_index.suggest(query, limit)})
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
 
 @app.route('/api/products/<int:product_id>', methods=['GET'])
 def get_product(product_id):
-    product = Product.query.filter_by(id=product_id, is_active=True).first()
-    if not product:
+    product_data = product_reads.get(('product', product_id), lambda: build_product_detail(product_id))
+    if product_data is None:
         return jsonify({'error': 'المنتج غير موجود'}), 404
     
-    # زيادة عدد المشاهدات
-    product.views_count += 1
+    # زيادة عدد المشاهدات بتحديث ذري واحد (قيمة views_count في الرد قد تتأخر حتى تحديث الذاكرة المؤقتة)
+    Product.query.filter_by(id=product_id).update(
+        {Product.views_count: func.coalesce(Product.views_count, 0) + 1}, synchronize_session=False)
     db.session.commit()
-    
-    # جلب التقييمات
-    reviews = Review.query.filter_by(product_id=product_id, is_approved=True).order_by(Review.created_at.desc()).all()
-    
-    product_data = product.to_dict()
-    product_data['reviews'] = [review.to_dict() for review in reviews]
-    product_data['average_rating'] = sum(r.rating for r in reviews) / len(reviews) if reviews else 0
+    suggestion_index.record_view(product_id)
     
     return jsonify(product_data)
 
+@app.route('/api/products/<int:product_id>/related', methods=['GET'])
+def get_related_products(product_id):
+    relations = ProductRelation.query \
+        .options(joinedload(ProductRelation.related_product).joinedload(Product.category)) \
+        .filter_by(product_id=product_id) \
+        .order_by(ProductRelation.relation_type, ProductRelation.rank).all()
+    
+    # التحقق من وجود المنتج فقط عند عدم وجود علاقات، حتى يبقى الطلب العادي استعلاماً مفهرساً واحداً
+    if not relations and not db.session.query(Product.id).filter_by(id=product_id, is_active=True).first():
+        return jsonify({'error': 'المنتج غير موجود'}), 404
+    
+    result = {'related': [], 'bought_together': []}
+    for relation in relations:
+        if relation.related_product and relation.related_product.is_active:
+            result[relation.relation_type].append(relation.related_product.to_dict())
+    return jsonify(result)
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -562,6 +1583,7 @@ def get_cart():
     })
 
 @app.route('/api/cart/add', methods=['POST'])
+@idempotent
 def add_to_cart():
     user_id = session.get('user_id')
     print(f"Adding to cart for user_id: {user_id}") # إضافة لغرض التصحيح
@@ -691,6 +1713,7 @@ def clear_cart():
     }), 200
 
 @app.route('/api/orders', methods=['POST'])
+@idempotent
 def create_order():
     user_id = session.get('user_id')
     if not user_id:
@@ -733,6 +1756,8 @@ def create_order():
             product_id=item.product_id,
             quantity=item.quantity,
             price=item.product.final_price,
+            product_name=item.product.name,
+            product_image=item.product.thumbnail_url(),
             selected_size=item.selected_size,
             selected_color=item.selected_color,
             notes=item.notes
@@ -760,10 +1785,94 @@ def get_user_orders():
     if not user_id:
         return jsonify({'error': 'يرجى تسجيل الدخول لعرض الطلبات'}), 401
     
-    orders = Order.query.filter_by(user_id=user_id).order_by(Order.created_at.desc()).all()
-    return jsonify([order.to_dict() for order in orders])
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', app.config['ORDERS_PER_PAGE'], type=int),
+                   app.config['ORDERS_MAX_PER_PAGE'])
+    summary = request.args.get('summary') == 'true'
+    
+    query = Order.query.filter_by(user_id=user_id).order_by(Order.created_at.desc())
+    if summary:
+        query = query.options(selectinload(Order.order_items))
+    else:
+        query = query.options(selectinload(Order.order_items).joinedload(OrderItem.product).joinedload(Product.category))
+    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+    
+    return jsonify({
+        'orders': [order.to_summary_dict() if summary else order.to_dict() for order in pagination.items],
+        'page': pagination.page,
+        'per_page': pagination.per_page,
+        'total': pagination.total,
+        'pages': pagination.pages
+    })
+
+@app.route('/api/orders/<int:order_id>', methods=['GET'])
+def get_order(order_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'يرجى تسجيل الدخول لعرض الطلبات'}), 401
+    
+    order = Order.query.filter_by(id=order_id, user_id=user_id).first()
+    if not order:
+        return jsonify({'error': 'الطلب غير موجود'}), 404
+    return jsonify(order.to_dict())
+
+@app.route('/api/orders/stream', methods=['GET'])
+def stream_order_updates():
+    """بث تغييرات حالة طلبات المستخدم عبر Server-Sent Events بدلاً من الاستعلام المتكرر"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'يرجى تسجيل الدخول لمتابعة الطلبات'}), 401
+    
+    keepalive = app.config['ORDER_STREAM_KEEPALIVE']
+    poll_interval = app.config['ORDER_STREAM_POLL_INTERVAL']
+    
+    rows = get_order_statuses(user_id)
+    known_statuses = {row.id: row.status for row in rows}
+    last_seen = max((row.updated_at for row in rows if row.updated_at), default=datetime.utcnow())
+    db.session.remove()  # لا نحتفظ باتصال قاعدة البيانات طوال مدة البث
+    
+    subscription = order_events.subscribe(user_id)
+    
+    def generate():
+        nonlocal last_seen
+        try:
+            yield 'retry: 5000\n\n'
+            last_sent = time.monotonic()
+            while True:
+                # التغييرات من هذه العملية تصل فوراً، ومن العمليات الأخرى عبر الفحص الدوري
+                try:
+                    payloads = [subscription.get(timeout=poll_interval)]
+                except queue.Empty:
+                    payloads = []
+                    changed = []
+                    # لا داعي لفحص قاعدة البيانات إن كانت كل الطلبات في حالة نهائية
+                    if any(status not in Order.FINAL_STATUSES for status in known_statuses.values()):
+                        with app.app_context():
+                            changed = get_order_statuses(user_id, since=last_seen)
+                    for row in changed:
+                        last_seen = max(last_seen, row.updated_at)
+                        payloads.append(order_status_payload(row.id, row.order_number, row.status, row.updated_at))
+                
+                for payload in payloads:
+                    previous = known_statuses.get(payload['order_id'])
+                    known_statuses[payload['order_id']] = payload['status']
+                    # الطلب الجديد ليس تغييراً في الحالة، وتعديل حقول أخرى لا يهم العميل هنا
+                    if previous == payload['status'] or (previous is None and payload['status'] == 'pending'):
+                        continue
+                    yield f"event: order_status\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                    last_sent = time.monotonic()
+                
+                if time.monotonic() - last_sent >= keepalive:
+                    yield ': keepalive\n\n'
+                    last_sent = time.monotonic()
+        finally:
+            order_events.unsubscribe(user_id, subscription)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/contact', methods=['POST'])
+@idempotent
 def submit_contact_message():
     data = request.get_json()
     name = data.get('name')
@@ -788,6 +1897,7 @@ def submit_contact_message():
     return jsonify({'message': 'تم إرسال رسالتك بنجاح!'}), 201
 
 @app.route('/api/reviews', methods=['POST'])
+@idempotent
 def add_review():
     user_id = session.get('user_id')
     if not user_id:
@@ -835,11 +1945,86 @@ def get_current_user():
         return jsonify({'user': user.to_dict()}), 200
     return jsonify({'user': None}), 200
 
+@app.route('/api/admin/orders/<int:order_id>/status', methods=['PUT'])
+def update_order_status(order_id):
+    if not session.get('is_admin'):
+        return jsonify({'error': 'غير مصرح'}), 403
+    
+    status = (request.get_json() or {}).get('status')
+    if status not in Order.STATUS_TEXT:
+        return jsonify({'error': 'حالة الطلب غير صالحة'}), 400
+    
+    order = Order.query.get(order_id)
+    if not order:
+        return jsonify({'error': 'الطلب غير موجود'}), 404
+    
+    order.status = status
+    db.session.commit()
+    return jsonify({'message': 'تم تحديث حالة الطلب بنجاح', 'order': order.to_summary_dict()})
+
+@app.route('/api/admin/metrics', methods=['GET'])
+def get_metrics():
+    if not session.get('is_admin'):
+        return jsonify({'error': 'غير مصرح'}), 403
+    return jsonify({'product_reads': dict(product_reads.stats)})
+
+@app.route('/api/bootstrap', methods=['GET'])
+def get_bootstrap():
+    """كل ما تحتاجه الواجهة للعرض الأول في طلب واحد"""
+    limit = app.config['BOOTSTRAP_PRODUCTS_LIMIT']
+    latest = get_cached_fragment(('products', 'latest', limit),
+                                 lambda: build_products_fragment(limit=limit + 1))
+
+    data = {
+        'categories': get_cached_fragment('categories', build_categories_fragment),
+        'featured_products': get_cached_fragment(('products', 'featured', limit),
+                                                 lambda: build_products_fragment(featured_only=True, limit=limit)),
+        'products': latest[:limit],
+        'has_more_products': len(latest) > limit,
+        'user': None,
+        'cart': {'count': 0, 'total': 0}
+    }
+
+    user_id = session.get('user_id')
+    if user_id:
+        user = User.query.get(user_id)
+        if user:
+            data['user'] = user.to_dict()
+            data['cart'] = get_cart_summary(user_id)
+
+    return jsonify(data)
+
 
 # إنشاء الجداول عند تشغيل التطبيق لأول مرة
 with app.app_context():
     db.create_all()
+    upgrade_schema()
     init_sample_data()
 
+_background_tasks_started = False
+_background_tasks_lock = threading.Lock()
+
+def start_background_tasks():
+    start_periodic_task('idempotency-purge', app.config['IDEMPOTENCY_PURGE_INTERVAL'],
+                        purge_expired_idempotency_records)
+    start_periodic_task('cart-sweeper', app.config['CART_SWEEP_INTERVAL'], sweep_expired_cart_items)
+    start_periodic_task('search-index', app.config['SEARCH_INDEX_REBUILD_INTERVAL'], refresh_suggestion_index)
+    if np is not None:
+        start_periodic_task('recommendations', app.config['RECOMMENDATIONS_REFRESH_INTERVAL'],
+                            build_product_relations)
+
+# تبدأ المهام الخلفية مع أول طلب في كل عملية تخدم الطلبات (flask run، gunicorn، أو أي خادم WSGI)
+# ولا تبدأ في أوامر CLI أو في العملية الأم لإعادة التحميل التلقائي
+@app.before_request
+def _ensure_background_tasks():
+    global _background_tasks_started
+    if _background_tasks_started or not app.config['BACKGROUND_TASKS_ENABLED']:
+        return
+    with _background_tasks_lock:
+        if _background_tasks_started:
+            return
+        _background_tasks_started = True
+    start_background_tasks()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file